@@ -2,168 +2,192 @@
 from __future__ import annotations
 
 import argparse
+import importlib.util
+import mmap
+import os
 import shutil
+import struct
 import subprocess
 import sys
 import tempfile
 import threading
 import time
 import uuid
-import zipfile
-from datetime import datetime
+import zlib
+from collections.abc import Callable, Iterator
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 
+try:
+    # ISA-L's deflate is several times faster than zlib's and emits the same
+    # raw stream format, so it is preferred when installed.
+    from isal import isal_zlib as _deflate_zlib
+except ImportError:
+    _deflate_zlib = zlib
+
 VIDEO_EXTS = {".mp4", ".mov", ".m4v", ".mkv", ".webm", ".avi"}
+VIDEOTOOLBOX_ENCODER = "h264_videotoolbox"
+ENCODERS = ("auto", "libx264", VIDEOTOOLBOX_ENCODER)
+
+ZIP_LOCAL_HEADER = struct.Struct("<4s2B4HL2L2H")
+ZIP_CENTRAL_HEADER = struct.Struct("<4s4B4HL2L5H2L")
+ZIP_END_RECORD = struct.Struct("<4s4H2LH")
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+ZIP_MAX_SIZE = 0xFFFFFFFF
+ZIP_EXTERNAL_ATTR = 0o600 << 16
+ZIP_LOCAL_CRC_OFFSET = 14
+ZIP_COPY_CHUNK = 4 << 20
+
+
+def iter_videos(root: str | os.PathLike[str]) -> Iterator[Path]:
+    try:
+        entries = list(os.scandir(root))
+    except OSError:
+        return
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            yield from iter_videos(entry.path)
+        elif entry.is_file() and os.path.splitext(entry.name)[1].lower() in VIDEO_EXTS:
+            yield Path(entry.path)
 
 
 def run_cmd(cmd: list[str], label: str) -> None:
+    # Only stderr is kept, and it is decoded only when it is reported.
     result = subprocess.run(
         cmd,
-        capture_output=True,
-        text=True,
-        encoding="utf-8",
-        errors="replace",
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
         check=False,
     )
     if result.returncode != 0:
-        err = (result.stderr or result.stdout or "").strip()
+        err = (result.stderr or b"").decode("utf-8", "replace").strip()
         raise RuntimeError(f"{label} failed: {err}")
 
 
-def has_audio(ffprobe_path: str, src: Path) -> bool:
-    result = subprocess.run(
-        [
-            ffprobe_path,
-            "-v",
-            "error",
-            "-select_streams",
-            "a",
-            "-show_entries",
-            "stream=index",
-            "-of",
-            "csv=p=0",
-            str(src),
-        ],
-        capture_output=True,
-        text=True,
-        encoding="utf-8",
-        errors="replace",
-        check=False,
-    )
+def has_encoder(ffmpeg_path: str, name: str) -> bool:
+    try:
+        result = subprocess.run(
+            [ffmpeg_path, "-hide_banner", "-encoders"],
+            capture_output=True,
+            text=True,
+            encoding="utf-8",
+            errors="replace",
+            check=False,
+        )
+    except OSError:
+        return False
     if result.returncode != 0:
         return False
-    return bool((result.stdout or "").strip())
+    return any(line.split()[1:2] == [name] for line in (result.stdout or "").splitlines())
+
+
+def build_filter(fps: int, max_width: int, max_height: int) -> str:
+    # A single scale both fits the frame and rounds it down to even sizes;
+    # bilinear is cheaper than the default bicubic for these downscales.
+    return (
+        f"scale=w=min({max_width}\\,iw):h=min({max_height}\\,ih):"
+        "force_original_aspect_ratio=decrease:force_divisible_by=2:flags=bilinear,"
+        f"fps={fps}"
+    )
 
 
 def build_video(
     ffmpeg_path: str,
-    ffprobe_path: str,
     src: Path,
     dst: Path,
+    still_dst: Path,
+    cover_time: float,
     max_duration: float,
-    fps: int,
-    max_width: int,
-    max_height: int,
+    vf: str,
+    threads: int,
+    encoder: str,
 ) -> None:
-    vf = (
-        f"scale=min({max_width}\\,iw):min({max_height}\\,ih):"
-        "force_original_aspect_ratio=decrease,"
-        "scale=trunc(iw/2)*2:trunc(ih/2)*2,"
-        f"fps={fps}"
+    # The cover still is taken from the same scaled frames as a second output,
+    # so one ffmpeg run produces both files without re-reading the movie.
+    graph = (
+        f"[0:v:0]{vf},split=2[mov][still];"
+        f"[still]setpts=PTS-STARTPTS,select=gte(t\\,{cover_time:.3f})[cover]"
     )
-    audio = has_audio(ffprobe_path, src)
-    if audio:
-        cmd = [
-            ffmpeg_path,
-            "-y",
-            "-i",
-            str(src),
-            "-map",
-            "0:v:0",
-            "-map",
-            "0:a:0",
-            "-vf",
-            vf,
-            "-t",
-            f"{max_duration:.3f}",
-            "-c:v",
-            "libx264",
-            "-pix_fmt",
-            "yuv420p",
-            "-profile:v",
-            "high",
-            "-level",
-            "4.1",
-            "-c:a",
-            "aac",
-            "-b:a",
-            "128k",
-            "-ar",
-            "44100",
-            "-ac",
-            "2",
-            "-shortest",
-            str(dst),
-        ]
+    # Each parallel job gets a fixed thread budget for decoding, filtering and
+    # encoding so concurrent builds do not oversubscribe the cores, whichever
+    # encoder is in use.
+    if encoder == VIDEOTOOLBOX_ENCODER:
+        # Decode and encode on the media engine; allow_sw keeps machines
+        # without a hardware session (e.g. CI VMs) working.
+        hwaccel = ["-hwaccel", "videotoolbox"]
+        video_codec = ["-c:v", encoder, "-b:v", "8M", "-allow_sw", "1"]
     else:
-        cmd = [
-            ffmpeg_path,
-            "-y",
-            "-i",
-            str(src),
-            "-f",
-            "lavfi",
-            "-i",
-            "anullsrc=channel_layout=stereo:sample_rate=44100",
-            "-map",
-            "0:v:0",
-            "-map",
-            "1:a:0",
-            "-vf",
-            vf,
-            "-t",
-            f"{max_duration:.3f}",
+        # The x264 frame and lookahead threads share the same per-job budget
+        # as the decoder and filter graph.
+        hwaccel = []
+        video_codec = [
+            "-threads",
+            str(threads),
+            "-x264-params",
+            f"threads={threads}:lookahead-threads={max(1, threads // 4)}",
             "-c:v",
             "libx264",
-            "-pix_fmt",
-            "yuv420p",
-            "-profile:v",
-            "high",
-            "-level",
-            "4.1",
-            "-c:a",
-            "aac",
-            "-b:a",
-            "128k",
-            "-ar",
-            "44100",
-            "-ac",
-            "2",
-            "-shortest",
-            str(dst),
         ]
+    # The silent track is always mapped after the optional source audio, so it
+    # is the first audio track only when the source has none. The AVFoundation
+    # rewrite in add_still_image_time_track keeps just that first track, which
+    # saves a separate ffprobe run to decide between the two layouts.
+    cmd = [
+        ffmpeg_path,
+        "-hide_banner",
+        "-loglevel",
+        "error",
+        "-y",
+        *hwaccel,
+        "-threads",
+        str(threads),
+        "-i",
+        str(src),
+        "-f",
+        "lavfi",
+        "-i",
+        "anullsrc=channel_layout=stereo:sample_rate=44100",
+        "-filter_complex_threads",
+        str(threads),
+        "-filter_complex",
+        graph,
+        "-map",
+        "[mov]",
+        "-map",
+        "0:a:0?",
+        "-map",
+        "1:a:0",
+        "-t",
+        f"{max_duration:.3f}",
+        *video_codec,
+        "-pix_fmt",
+        "yuv420p",
+        "-profile:v",
+        "high",
+        "-level",
+        "4.1",
+        "-c:a",
+        "aac",
+        "-b:a",
+        "128k",
+        "-ar",
+        "44100",
+        "-ac",
+        "2",
+        "-shortest",
+        str(dst),
+        "-map",
+        "[cover]",
+        "-frames:v",
+        "1",
+        "-q:v",
+        "2",
+        str(still_dst),
+    ]
     run_cmd(cmd, "ffmpeg video")
 
 
-def extract_still(ffmpeg_path: str, src: Path, dst: Path, cover_time: float) -> None:
-    run_cmd(
-        [
-            ffmpeg_path,
-            "-y",
-            "-ss",
-            f"{cover_time:.3f}",
-            "-i",
-            str(src),
-            "-frames:v",
-            "1",
-            "-q:v",
-            "2",
-            str(dst),
-        ],
-        "ffmpeg still",
-    )
-
-
 def add_still_image_time_track(video_path: Path, content_id: str) -> None:
     if sys.platform != "darwin":
         raise RuntimeError("Live Photo metadata requires macOS.")
@@ -373,48 +397,209 @@ def write_metadata(image_path: Path, video_path: Path, content_id: str) -> None:
         raise RuntimeError(f"Live Photo metadata failed: {exc}") from exc
 
 
-def pack_livp(photo_path: Path, video_path: Path, out_path: Path, internal_base: str) -> None:
+def deflate_raw(data: memoryview | bytes) -> bytes:
+    compressor = _deflate_zlib.compressobj(wbits=-15)
+    return compressor.compress(data) + compressor.flush()
+
+
+def pack_livp(
+    photo_path: Path,
+    video_path: Path,
+    out_path: Path,
+    internal_base: str,
+    compressor: Callable[[memoryview], bytes] | None = None,
+) -> None:
     photo_name = f"{internal_base}.jpeg"
     video_name = f"{internal_base}.mov"
-    with zipfile.ZipFile(out_path, "w") as zf:
-        for src_path, arcname in (
-            (photo_path, photo_name),
-            (video_path, video_name),
-        ):
-            try:
-                ts = src_path.stat().st_mtime
-                dt = datetime.fromtimestamp(ts)
-                date_time = (dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second)
-            except Exception:
-                date_time = (1980, 1, 1, 0, 0, 0)
-            info = zipfile.ZipInfo(filename=arcname, date_time=date_time)
-            info.compress_type = zipfile.ZIP_STORED
-            info.flag_bits = 0
-            info.create_system = 0
-            info.create_version = 0
-            info.extract_version = 20
-            info.external_attr = 0
-            zf.writestr(info, src_path.read_bytes(), compress_type=zipfile.ZIP_STORED)
+    # The archive always holds two entries, so the headers are written directly
+    # instead of going through zipfile's per-entry bookkeeping. The field values
+    # match what zipfile produced for these entries. `compressor` (e.g.
+    # deflate_raw) must return a raw deflate stream and only applies to the
+    # photo; the movie is already compressed and is always STORED.
+    # Write next to the target and swap it in only when complete, so a failed
+    # build never replaces (or truncates) the previous archive.
+    tmp_out = out_path.with_name(f"{out_path.name}.tmp")
+    central = []
+    try:
+        with open(tmp_out, "wb") as out:
+            for src_path, arcname, entry_compressor in (
+                (photo_path, photo_name, compressor),
+                (video_path, video_name, None),
+            ):
+                st = src_path.stat()
+                try:
+                    date_time = time.localtime(st.st_mtime)[:6]
+                except Exception:
+                    date_time = (1980, 1, 1, 0, 0, 0)
+                if date_time[0] < 1980:
+                    date_time = (1980, 1, 1, 0, 0, 0)
+                dos_time = date_time[3] << 11 | date_time[4] << 5 | date_time[5] // 2
+                dos_date = (date_time[0] - 1980) << 9 | date_time[1] << 5 | date_time[2]
+                name = arcname.encode("ascii")
+                offset = out.tell()
+                if st.st_size >= ZIP_MAX_SIZE or offset >= ZIP_MAX_SIZE:
+                    raise RuntimeError(f"{arcname} is too large for a LIVP archive.")
+                with open(src_path, "rb") as src, (
+                    mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ)
+                    if st.st_size
+                    else memoryview(b"")
+                ) as payload, memoryview(payload) as view:
+                    if entry_compressor is None:
+                        method = ZIP_STORED
+                        data = None
+                        compress_size = st.st_size
+                    else:
+                        method = ZIP_DEFLATED
+                        data = entry_compressor(view)
+                        compress_size = len(data)
+                    out.write(
+                        ZIP_LOCAL_HEADER.pack(
+                            b"PK\x03\x04",
+                            20,
+                            0,
+                            0,
+                            method,
+                            dos_time,
+                            dos_date,
+                            0,
+                            compress_size,
+                            st.st_size,
+                            len(name),
+                            0,
+                        )
+                    )
+                    out.write(name)
+                    if data is None:
+                        # The CRC is folded in per chunk while the chunk is still
+                        # hot in cache, then patched into the local header.
+                        crc = 0
+                        for start in range(0, st.st_size, ZIP_COPY_CHUNK):
+                            with view[start : start + ZIP_COPY_CHUNK] as chunk:
+                                crc = zlib.crc32(chunk, crc)
+                                out.write(chunk)
+                    else:
+                        crc = zlib.crc32(view)
+                        out.write(data)
+                    end = out.tell()
+                    out.seek(offset + ZIP_LOCAL_CRC_OFFSET)
+                    out.write(struct.pack("<L", crc))
+                    out.seek(end)
+                central.append(
+                    ZIP_CENTRAL_HEADER.pack(
+                        b"PK\x01\x02",
+                        0,
+                        0,
+                        20,
+                        0,
+                        0,
+                        method,
+                        dos_time,
+                        dos_date,
+                        crc,
+                        compress_size,
+                        st.st_size,
+                        len(name),
+                        0,
+                        0,
+                        0,
+                        0,
+                        ZIP_EXTERNAL_ATTR,
+                        offset,
+                    )
+                    + name
+                )
+            directory = b"".join(central)
+            directory_offset = out.tell()
+            if directory_offset >= ZIP_MAX_SIZE:
+                raise RuntimeError(f"{out_path.name} is too large for a LIVP archive.")
+            out.write(directory)
+            out.write(
+                ZIP_END_RECORD.pack(
+                    b"PK\x05\x06",
+                    0,
+                    0,
+                    len(central),
+                    len(central),
+                    len(directory),
+                    directory_offset,
+                    0,
+                )
+            )
+        tmp_out.replace(out_path)
+    except Exception:
+        tmp_out.unlink(missing_ok=True)
+        raise
+
+
+def stamp_path_for(out_path: Path) -> Path:
+    return out_path.with_name(f"{out_path.name}.stamp")
+
+
+def source_stamp(src: Path, settings: tuple) -> str:
+    st = src.stat()
+    return f"{src.resolve()}\t{st.st_size}\t{st.st_mtime_ns}\t{settings!r}\n"
+
+
+def is_up_to_date(out_path: Path, stamp: str) -> bool:
+    try:
+        return out_path.is_file() and (
+            stamp_path_for(out_path).read_text(encoding="utf-8") == stamp
+        )
+    except OSError:
+        return False
+
+
+def stamp_owner(out_path: Path) -> str | None:
+    try:
+        return stamp_path_for(out_path).read_text(encoding="utf-8").split("\t", 1)[0]
+    except OSError:
+        return None
+
+
+def preflight(encoder: str) -> tuple[str, str]:
+    # Check every tool the pipeline needs before the batch starts, so a
+    # missing dependency does not surface only after the first encode.
+    ffmpeg_path = shutil.which("ffmpeg")
+    if ffmpeg_path is None:
+        raise RuntimeError("ffmpeg was not found on PATH.")
+    run_cmd([ffmpeg_path, "-version"], "ffmpeg -version")
+    if sys.platform != "darwin":
+        raise RuntimeError("Live Photo metadata requires macOS.")
+    missing = [
+        name
+        for name in ("makelive", "AVFoundation", "CoreMedia")
+        if importlib.util.find_spec(name) is None
+    ]
+    if missing:
+        raise RuntimeError(
+            f"Missing Python modules: {', '.join(missing)}. "
+            "Install them with: python3 -m pip install makelive pyobjc-framework-CoreMedia"
+        )
+    if encoder == "auto":
+        encoder = (
+            VIDEOTOOLBOX_ENCODER
+            if has_encoder(ffmpeg_path, VIDEOTOOLBOX_ENCODER)
+            else "libx264"
+        )
+    elif encoder == VIDEOTOOLBOX_ENCODER and not has_encoder(ffmpeg_path, encoder):
+        raise RuntimeError(f"{encoder} is not available in this ffmpeg build.")
+    return ffmpeg_path, encoder
 
 
 def build_livp(
     ffmpeg_path: str,
-    ffprobe_path: str,
     src: Path,
-    out_dir: Path,
+    out_path: Path,
     index: int,
     cover_time: float,
     max_duration: float,
-    fps: int,
-    max_width: int,
-    max_height: int,
+    vf: str,
+    threads: int,
+    encoder: str,
+    stamp: str,
 ) -> Path:
     content_id = str(uuid.uuid4()).upper()
     internal_base = f"IMG_{index:04d}.JPG"
-    out_name = f"{src.stem}.livp"
-    out_path = out_dir / out_name
-    if out_path.exists():
-        out_path = out_dir / f"{src.stem}_{index:04d}.livp"
 
     with tempfile.TemporaryDirectory(prefix="livp_") as tmpdir:
         tmpdir_path = Path(tmpdir)
@@ -422,17 +607,20 @@ def build_livp(
         tmp_jpeg = tmpdir_path / "livephoto.jpeg"
         build_video(
             ffmpeg_path,
-            ffprobe_path,
             src,
             tmp_mov,
+            tmp_jpeg,
+            cover_time,
             max_duration,
-            fps,
-            max_width,
-            max_height,
+            vf,
+            threads,
+            encoder,
         )
-        extract_still(ffmpeg_path, tmp_mov, tmp_jpeg, cover_time)
         write_metadata(tmp_jpeg, tmp_mov, content_id)
         pack_livp(tmp_jpeg, tmp_mov, out_path, internal_base)
+    # The old stamp stays until the new archive is in place, so an unfinished
+    # rebuild keeps both the previous output and its owner.
+    stamp_path_for(out_path).write_text(stamp, encoding="utf-8")
 
     return out_path
 
@@ -446,6 +634,18 @@ def main() -> int:
     parser.add_argument("--fps", type=str, default="30", help="Output FPS.")
     parser.add_argument("--max-width", type=str, default="3840", help="Max width.")
     parser.add_argument("--max-height", type=str, default="2160", help="Max height.")
+    parser.add_argument(
+        "--jobs",
+        type=str,
+        default="",
+        help="Number of files to build in parallel (default: half the CPU cores).",
+    )
+    parser.add_argument(
+        "--encoder",
+        type=str,
+        default="auto",
+        help=f"H.264 encoder: {', '.join(ENCODERS)} (auto prefers VideoToolbox).",
+    )
     args = parser.parse_args()
 
     def _parse_float(value: str, default: float, label: str) -> float:
@@ -472,12 +672,22 @@ def main() -> int:
         fps = _parse_int(args.fps, 30, "--fps")
         max_width = _parse_int(args.max_width, 3840, "--max-width")
         max_height = _parse_int(args.max_height, 2160, "--max-height")
+        jobs = _parse_int(args.jobs, max(1, (os.cpu_count() or 1) // 2), "--jobs")
+        if jobs < 1:
+            raise ValueError("--jobs must be at least 1.")
+        encoder = (args.encoder or "").strip() or "auto"
+        if encoder not in ENCODERS:
+            raise ValueError(f"--encoder must be one of: {', '.join(ENCODERS)}.")
     except ValueError as exc:
         print(f"Argument error: {exc}")
         return 2
+    threads_per_job = max(1, (os.cpu_count() or 1) // jobs)
 
-    ffmpeg_path = shutil.which("ffmpeg") or "ffmpeg"
-    ffprobe_path = shutil.which("ffprobe") or "ffprobe"
+    try:
+        ffmpeg_path, encoder = preflight(encoder)
+    except (OSError, RuntimeError) as exc:
+        print(f"Preflight failed: {exc}")
+        return 1
 
     input_dir = Path(args.input)
     output_dir = Path(args.output)
@@ -486,35 +696,74 @@ def main() -> int:
         return 1
     output_dir.mkdir(parents=True, exist_ok=True)
 
-    sources = [
-        path
-        for path in sorted(input_dir.rglob("*"))
-        if path.is_file() and path.suffix.lower() in VIDEO_EXTS
-    ]
+    sources = sorted(iter_videos(input_dir))
     if not sources:
         print("No video files found in input folder.")
         return 1
 
     print(f"Found {len(sources)} video file(s).")
-    for idx, src in enumerate(sources, start=1):
-        print(f"Processing: {src.name}")
-        try:
-            out_path = build_livp(
+    print(f"Encoder: {encoder}")
+    vf = build_filter(fps, max_width, max_height)
+    settings = (cover_time, max_duration, vf, encoder)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {}
+        claimed: set[Path] = set()
+        for idx, src in enumerate(sources, start=1):
+            # Output names are resolved up front so parallel workers never race
+            # for the same file when two sources share a stem.
+            try:
+                stamp = source_stamp(src, settings)
+            except OSError as exc:
+                print(f"Failed: {src.name} -> {exc}")
+                executor.shutdown(wait=True, cancel_futures=True)
+                return 1
+            alt_path = output_dir / f"{src.stem}_{idx:04d}.livp"
+            candidates = [
+                path
+                for path in (output_dir / f"{src.stem}.livp", alt_path)
+                if path not in claimed
+            ]
+            done = next((path for path in candidates if is_up_to_date(path, stamp)), None)
+            if done is not None:
+                claimed.add(done)
+                print(f"Up to date: {src.name} -> {done.name}")
+                continue
+            # A stale output of this same source is rebuilt in place; only a
+            # file owned by another source pushes the build to the alt name.
+            owner = stamp.split("\t", 1)[0]
+            out_path = next(
+                (
+                    path
+                    for path in candidates
+                    if not path.exists() or stamp_owner(path) == owner
+                ),
+                alt_path,
+            )
+            claimed.add(out_path)
+            print(f"Queued: {src.name}")
+            future = executor.submit(
+                build_livp,
                 ffmpeg_path,
-                ffprobe_path,
                 src,
-                output_dir,
+                out_path,
                 idx,
                 cover_time,
                 max_duration,
-                fps,
-                max_width,
-                max_height,
+                vf,
+                threads_per_job,
+                encoder,
+                stamp,
             )
-            print(f"Output: {out_path.name}")
-        except Exception as exc:
-            print(f"Failed: {src.name} -> {exc}")
-            return 1
+            futures[future] = src
+        for future in as_completed(futures):
+            src = futures[future]
+            try:
+                out_path = future.result()
+            except Exception as exc:
+                print(f"Failed: {src.name} -> {exc}")
+                executor.shutdown(wait=True, cancel_futures=True)
+                return 1
+            print(f"Output: {src.name} -> {out_path.name}")
     return 0
 
 